@@ -36,7 +36,7 @@ def main():
     autoenc = AutoEnc(autoenc_spec, run_spec)
 
     # Copy config file to the execution folder
-    if str(Path(config_file_str).parent) == '.':
+    if autoenc.rank == 0 and str(Path(config_file_str).parent) == '.':
         copyfile(config_file_str,
                  str(autoenc.out_name / config_file_str))
 
@@ -2,31 +2,47 @@
 
 import torch.cuda
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from contextlib import nullcontext
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
-from torchvision.datasets import ImageFolder
+from torchvision.datasets.folder import default_loader
+try:
+    from torchvision.io import read_file, decode_jpeg, ImageReadMode
+except ImportError:
+    read_file = decode_jpeg = None
 from pathlib import Path
 import numpy as np
-from multiprocessing import Process, Manager, Pool
+import multiprocessing as mp
+from threading import Thread
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import uuid
 from psutil import cpu_count
-import time
 import sys
+import inspect
+import warnings
+import os
 import pandas as pd
-from itertools import repeat, product
+from itertools import product
+from collections import deque
 from setproctitle import setproctitle
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FormatStrFormatter
 
-from .generator import Generator
+from .generator import Generator, ImgDataset
 from .enums import *
 from .torch_custom import *
 from .processing import ImgProc
+from .shared_array import SharedArray
 from traceback import print_exc
 
 CURSOR_UP_ONE = '\x1b[1A'
 ERASE_LINE = '\x1b[2K'
 
-# TODO: add checkpoint for models
 # TODO: add pytorch's schedules
 # TODO: use pytorch's multiprocessing
 # TODO: create custom data loader
@@ -37,6 +53,9 @@ class AutoEnc:
     """ Class representing the image autoencoders. It has all methods necessary
         to operate with them.
     """
+    # Pools used to analyse the outputs. They're shared by all executions
+    _cls_pools = None
+
     class State:
         """ Class with useful information about the current execution of the
             autoencoder. It provides the information of the instantiated model
@@ -52,19 +71,81 @@ class AutoEnc:
             self.loss = None
             self.out_queue = None
             self.device = None
+            self.scaler = None
+            self.staging = [None, None]
+            self.staging_idx = 0
+            self.copy_stream = None
 
     def __init__(self, autoencoder_conf, run_conf):
         self.auto_cfg = autoencoder_conf.copy()
         self.run_cfg = run_conf.copy()
         self.st = None
+        self.rank, self.local_rank, self.world_size = \
+            self._init_distributed()
+        self._enable_tf32()
+        # The first process indexes the databases, if needed, before the
+        # others read the index files
+        if self.rank != 0:
+            dist.barrier()
         self.generators = self._instantiate_generators()
-        out = Path(self.run_cfg['out_folder'])
-        cnt = 0
-        while out.exists():
-            out = Path(self.run_cfg['out_folder'] + '_' + str(cnt))
-            cnt += 1
-        out.mkdir(parents=True, exist_ok=True)
-        self.out_name = out
+        if self.rank == 0 and self.world_size > 1:
+            dist.barrier()
+        self.out_name = self._create_run_folder()
+        self.ckpt_path_pattern = str(self.out_name / str(Folders.CHECKPOINTS)
+                                     / 'epoch{:d}_loss{:.4g}.ckpt')
+        # The checkpoints are written in background, one at a time
+        self._ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        self._ckpt_futures = []
+
+    @staticmethod
+    def _enable_tf32():
+        """ Allow TF32 tensor cores in the float32 matmuls and convolutions,
+            that run outside of autocast. It only affects Ampere or newer
+            GPUs, and older torch versions don't have these flags.
+        """
+        if not torch.cuda.is_available():
+            return
+        # cuDNN already allows TF32 by default
+        if hasattr(torch.backends, 'cuda') and \
+                hasattr(torch.backends.cuda, 'matmul'):
+            torch.backends.cuda.matmul.allow_tf32 = True
+        if hasattr(torch, 'set_float32_matmul_precision'):
+            torch.set_float32_matmul_precision('high')
+
+    @staticmethod
+    def _init_distributed():
+        """ Initialize the process group when the code is launched through
+            torchrun, that sets LOCAL_RANK for each process. It returns the
+            rank, the local rank and the world size of the execution.
+        """
+        if 'LOCAL_RANK' not in os.environ:
+            return 0, 0, 1
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group('nccl')
+        return dist.get_rank(), local_rank, dist.get_world_size()
+
+    def _create_run_folder(self):
+        """ Create the output folder of the execution. In distributed runs,
+            only the first process creates it and the others receive the
+            suffix of its name
+        """
+        base = self.run_cfg['out_folder']
+        # -1 means the folder has no suffix
+        suffix = -1
+        if self.rank == 0:
+            out = Path(base)
+            while out.exists():
+                suffix += 1
+                out = Path(base + '_' + str(suffix))
+            out.mkdir(parents=True, exist_ok=True)
+        if self.world_size > 1:
+            # Older torch versions only broadcast tensors, and NCCL needs
+            # them in the GPU
+            suffix = torch.tensor([suffix]).cuda()
+            dist.broadcast(suffix, src=0)
+            suffix = int(suffix.item())
+        return Path(base) if suffix < 0 else Path(base + '_' + str(suffix))
 
     @staticmethod
     def _clear_last_lines(n=1):
@@ -73,34 +154,69 @@ class AutoEnc:
             sys.stdout.write(CURSOR_UP_ONE)
             sys.stdout.write(ERASE_LINE)
 
+    def _data_loader_kwargs(self):
+        """ Arguments of the data loaders. In GPUs, the batches are put in
+            pinned memory, so that the copies to the device are asynchronous.
+            The workers are kept alive between the epochs if the installed
+            torch version supports it.
+        """
+        workers = self.run_cfg['workers']
+        kwargs = {'num_workers': workers,
+                  'pin_memory': torch.cuda.is_available()}
+        params = inspect.signature(DataLoader.__init__).parameters
+        if workers > 0 and 'persistent_workers' in params:
+            kwargs['persistent_workers'] = True
+        return kwargs
+
+    @staticmethod
+    def _is_gpu_decodable(images):
+        """ The images are decoded in the GPU only if all of them are JPEGs
+            and the installed torchvision can decode them in the device
+        """
+        if not torch.cuda.is_available() or decode_jpeg is None or \
+                'device' not in inspect.signature(decode_jpeg).parameters:
+            return False
+        return all(Path(path).suffix.lower() in ('.jpg', '.jpeg')
+                   for path, _ in images.samples)
+
+    @staticmethod
+    def _collate_encoded(batch):
+        """ Join the encoded images of a batch in a list, since they have
+            different lengths
+        """
+        data, targets = zip(*batch)
+        return list(data), torch.tensor(targets)
+
     def _instantiate_generators(self):
         """ Method to instantiate generator objects """
         shape = self.auto_cfg['input_shape']
         run = self.run_cfg['generators']
         gen = {}
-        img_transform = transforms.Compose([transforms.ToPILImage(),
-                                            transforms.RandomHorizontalFlip(),
-                                            transforms.RandomPerspective()])
         data_transforms = {
             'train': transforms.Compose([transforms.ToTensor()]),
             'test': transforms.Compose([transforms.ToTensor()])
         }
-        images = {
-            'train': ImageFolder(root=run['train']['path'],
-                                 transform=data_transforms['train']),
-            'test': ImageFolder(root=run['test']['path'],
-                                transform=data_transforms['test'])
-        }
-        data_loader = {
-            'train': DataLoader(images['train'], batch_size=shape[0],
-                                num_workers=self.run_cfg['workers']),
-            'test': DataLoader(images['test'], batch_size=shape[0],
-                               num_workers=self.run_cfg['workers'])
-        }
-
-        gen['train'] = Generator(shape, run['train']), data_loader['train']
-        gen['test'] = Generator(shape, run['test']), data_loader['test']
-        gen['img'] = img_transform
+        for mode in data_transforms:
+            # Only the enabled splits index their folders
+            if not run[mode]['enabled']:
+                continue
+            loader_kwargs = self._data_loader_kwargs()
+            generator = Generator(shape, run[mode])
+            images = ImgDataset(generator, loader=read_file)
+            if AutoEnc._is_gpu_decodable(images):
+                # The workers just read the files. The batches are lists of
+                # encoded JPEGs, decoded by nvJPEG in _data_to_device
+                loader_kwargs['num_workers'] = min(2, self.run_cfg['workers'])
+                loader_kwargs['collate_fn'] = AutoEnc._collate_encoded
+            else:
+                images.loader = default_loader
+                images.transform = data_transforms[mode]
+            # Each process trains with its own shard of the training set
+            sampler = DistributedSampler(images, shuffle=False) \
+                if mode == 'train' and self.world_size > 1 else None
+            data_loader = DataLoader(images, batch_size=shape[0],
+                                     sampler=sampler, **loader_kwargs)
+            gen[mode] = generator, data_loader
         return gen
 
     def _create_model(self):
@@ -136,28 +252,39 @@ class AutoEnc:
                 return x, b.clamp(0, 1)
 
         model = AutoEncoder()
-        self.device = torch.device(
-            "cuda:0" if torch.cuda.is_available() else "cpu")
+        self.device = torch.device('cuda:' + str(self.local_rank)
+                                   if torch.cuda.is_available() else "cpu")
         model = model.to(self.device)
+        if self.device.type == 'cuda':
+            # The input shape is fixed, so the cuDNN autotuner search is done
+            # only once. NHWC layout enables the tensor cores kernels.
+            torch.backends.cudnn.benchmark = True
+            if hasattr(torch, 'channels_last'):
+                model = model.to(memory_format=torch.channels_last)
+            # Testing is done only by the first process, so no replicas
+            if self.world_size > 1 and st.exec_mode == ExecMode.TRAIN:
+                model = DistributedDataParallel(
+                    model, device_ids=[self.local_rank])
+            if hasattr(torch, 'compile'):
+                # The input shape is static, so the CUDA graphs captured by
+                # reduce-overhead are replayed in every iteration
+                model = torch.compile(model, mode='reduce-overhead')
         st.autoenc.append(model)
+        if self._amp_enabled():
+            st.scaler = torch.cuda.amp.GradScaler()
 
         optimizer = Optimizers(conf['lr_politics']['optimizer']).value
         schedules = Schedules(conf['lr_politics']['schedule']).value \
             if conf['lr_politics']['schedule'] else Schedules('constant').value
+        # The schedules are updated once per optimizer step
+        steps = int(np.ceil(len(self.generators[str(st.exec_mode)][1]) /
+                            run.get('accumulation_steps', 1)))
         st.opt_schedules.append(schedules(
-            conf['lr_politics']['lr'],
-            len(self.generators[str(st.exec_mode)][1]), run['epochs']))
+            conf['lr_politics']['lr'], steps, run['epochs']))
         st.autoenc_opt.append(optimizer(model.parameters(),
                                         conf['lr_politics']['lr']))
         st.loss = Losses(conf['loss']).value
 
-    @staticmethod
-    def _timeout_msg(function, msg):
-        """ Auxiliary function to the asynchronous functions to print
-            a message of timeout
-        """
-        print('Timeout in', function, 'while processing', msg, end='\n\n')
-
     def _create_out_folder(self):
         """ Auxiliary function to _handle_output that creates the prediction
             folder
@@ -182,111 +309,163 @@ class AutoEnc:
         """ Auxiliary function of _handle_output. It saves a csv containing
             the analysis for all images wrt all metrics for each codec.
         """
-        def save_csv(data, csv_path, index, levels):
-            names = ['bpp'] + list(map(lambda x: str(x), Metrics))
-            cols = [x[0] + str(x[1]) for x in product(names, range(levels))]
-            df = pd.DataFrame(data, index=pd.Index(index, name='img'),
-                              columns=pd.Index(cols))
-            df = df.sort_index()
-            mean_df = pd.DataFrame(df.mean(axis=0).values.reshape(1, -1),
-                                   columns=df.columns, index=pd.Index(['mean']))
-            full_df = pd.concat((df, mean_df))
-            full_df.to_csv(str(csv_path), float_format='%.5f')
-
         csv_path = list(map(
             lambda s: folder / ('_metrics_' + str(s) + '.csv'), Codecs))
         # dims: (codecs, images, levels)
-        bpps = np.array(list(map(list, bpps_proxy)))
+        bpps = bpps_proxy[:]
         levels = bpps.shape[-1]
-        # dims: (codecs, metrics, images, levels)
-        metrics = np.array(list(map(list, metrics_proxy.flat))).reshape(
-            (*list(metrics_proxy.shape), len(bpps[0]), -1))
         # dims: (codecs, images, metrics, levels)
-        metrics = metrics.swapaxes(1, 2)
+        metrics = metrics_proxy[:].swapaxes(1, 2)
         # merge metrics and levels to just one dimension
         metrics = metrics.reshape((*list(metrics.shape[:-2]), -1))
         data = np.concatenate((bpps, metrics), axis=2)
-        list(map(save_csv, data, csv_path, repeat(img_paths),
-                 repeat(levels)))
+        # Images sorted by their paths
+        order = sorted(range(len(img_paths)), key=lambda i: img_paths[i])
+        data = data[:, order]
+        # Images not analysed are nan, and don't count in the mean
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            means = np.nanmean(data, axis=1, keepdims=True)
+        data = np.concatenate((data, means), axis=1)
+
+        names = ['bpp'] + list(map(lambda x: str(x), Metrics))
+        cols = pd.Index([x[0] + str(x[1])
+                         for x in product(names, range(levels))])
+        index = pd.Index([img_paths[i] for i in order] + ['mean'])
+        for codec_data, path in zip(data, csv_path):
+            pd.DataFrame(codec_data, index=index, columns=cols).to_csv(
+                str(path), float_format='%.5f')
 
     @staticmethod
     def _codecs_out_routines(pools, path, img_num, bpps, metrics,
-                             latents, patches, out_folder):
+                             latents, patches, out_folder, results):
         """ Auxiliary function of _handle_output. It does all routines necessary
-            to the outputs and analysis of the codecs
+            to the outputs and analysis of the codecs. The metrics run along
+            with the bpp, but the image is saved only after its bpp is
+            written, so that routine is dispatched by the callback of the bpp
+            one. The async results are appended to results.
         """
-        pools[0].apply_async(ImgProc.calc_bpp_using_gzip,
-                             (latents, path, bpps[Codecs.NET], img_num))
-        pools[1].apply_async(AutoEnc._save_imgs_from_patches,
-                             (path, out_folder, patches, bpps[Codecs.NET],
-                              metrics[Codecs.NET], img_num))
+        def save_img(_):
+            if np.isnan(bpps[Codecs.NET, img_num]).all():
+                print('Image not saved, bpp not computed:', path, end='\n\n')
+                return
+            new_path = AutoEnc.get_out_pathname(path, out_folder, '.png')
+            results.append(pools[1].apply_async(ImgProc.save_img,
+                                                (patches, new_path)))
+
+        results.append(pools[1].apply_async(
+            AutoEnc._calc_metrics_from_patches,
+            (path, patches, metrics, Codecs.NET, img_num)))
+        results.append(pools[0].apply_async(
+            ImgProc.calc_bpp_using_gzip,
+            (latents, path, bpps, (Codecs.NET, img_num)), callback=save_img))
 
     @staticmethod
     def _set_proc_name_in_pool(string):
         """ Auxiliary function to name the pool of processes """
         setproctitle(string)
 
+    @classmethod
+    def _get_pools(cls):
+        """ Return the pools used by _handle_output. They're created in the
+            first call and reused by the next executions. The workers are
+            renewed from time to time to bound their memory. They're started
+            by a forkserver, since forking this process, with CUDA and other
+            threads running, may deadlock the children.
+        """
+        if cls._cls_pools is None:
+            # positions: bpp, orig img, net, jpeg, jpeg2k, plots
+            num_procs = np.array([.30, .45])
+            num_procs = np.ceil(num_procs * cpu_count()).astype(int)
+            names = list(map(
+                lambda n: 'python3 - ' + n,
+                ['calc_bpp_using_gzip', '_calc_metrics_from_patches']))
+            ctx = mp.get_context('forkserver')
+            cls._cls_pools = [
+                ctx.Pool(n_proc, AutoEnc._set_proc_name_in_pool, (name,),
+                         maxtasksperchild=256)
+                for n_proc, name in zip(num_procs, names)]
+            atexit.register(cls._close_pools)
+        return cls._cls_pools
+
+    @classmethod
+    def _close_pools(cls):
+        """ Finish the pools at the exit of the interpreter """
+        if cls._cls_pools is not None:
+            list(map(lambda p: p.close(), cls._cls_pools))
+            list(map(lambda p: p.join(), cls._cls_pools))
+            cls._cls_pools = None
+
     @staticmethod
-    def _instantiate_shared_variables(var_len):
-        """ Auxiliary function that instantiate the variables maintained by
-            the manager. It's used in _handle_output function
+    def _instantiate_shared_variables(var_len, prefix):
+        """ Auxiliary function that instantiate the variables shared with the
+            pools. It's used in _handle_output function. The results are
+            written in shared memory arrays, whose files are named with the
+            prefix. Positions not yet computed are nan.
         """
-        # positions: bpp, orig img, net, jpeg, jpeg2k, plots
-        num_procs = np.array([.30, .45])
-        num_procs = np.ceil(num_procs * cpu_count()).astype(int)
-        names = list(map(
-            lambda n: 'python3 - ' + n,
-            ['calc_bpp_using_gzip', '_save_imgs_from_patches']))
-        pools = [Pool(n_proc, AutoEnc._set_proc_name_in_pool, (name,))
-                 for n_proc, name in zip(num_procs, names)]
-        manager = Manager()
         n_codecs, n_metrics = len(Codecs), len(Metrics)
-        bpps = np.empty((n_codecs,), dtype=object)
-        bpps[:] = [manager.list([None] * var_len) for _ in range(n_codecs)]
-        metrics = np.empty((n_codecs * n_metrics,), dtype=object)
-        metrics[:] = [manager.list([None] * var_len)
-                      for _ in range(n_codecs * n_metrics)]
-        metrics = metrics.reshape((n_codecs, n_metrics))
+        # Each image has only one quality level for now
+        levels = 1
+        bpps = SharedArray(prefix + '_bpps', (n_codecs, var_len, levels))
+        metrics = SharedArray(prefix + '_metrics',
+                              (n_codecs, n_metrics, var_len, levels),
+                              dtype=np.float32)
+        bpps[:], metrics[:] = np.nan, np.nan
 
-        return pools, bpps, metrics
+        return bpps, metrics
 
     def _handle_output(self):
-        """ Routine executed to handle the output of the model """
-        setproctitle('python3 - _handle_output')
+        """ Routine executed to handle the output of the model. It runs in a
+            thread, dispatching the analysis of each image to the pools.
+        """
         gen = self.generators[str(self.st.exec_mode)][0]
         out_folder = self._create_out_folder()
         img_pathnames = list(gen.get_db_files_pathnames())
-        pools, bpps, metrics = self._instantiate_shared_variables(
-            len(img_pathnames))
+        pools = self._get_pools()
+        prefix = self.out_name.stem + '_' + uuid.uuid4().hex[:8]
+        bpps, metrics = self._instantiate_shared_variables(
+            len(img_pathnames), prefix)
 
+        results = deque()
         for img_num, img in enumerate(img_pathnames):
             model_data, latents = self.st.out_queue.get()
+            # The queue has the tensors of the model, converted only here.
+            # They may be channels last, and gzip needs contiguous buffers.
+            model_data = np.ascontiguousarray(
+                model_data.permute(1, 2, 0).numpy())
+            latents = np.ascontiguousarray(latents.numpy())
             AutoEnc._codecs_out_routines(pools, img, img_num, bpps, metrics,
-                                         latents, model_data, out_folder)
-        list(map(lambda p: p.close(), pools))
-        list(map(lambda p: p.join(), pools))
+                                         latents, model_data, out_folder,
+                                         results)
+            # The results keep their callbacks, and so the outputs of the
+            # model. Release the finished ones as the execution goes on.
+            while results and results[0].ready():
+                results.popleft().get()
+            del model_data, latents
+        # Wait all the routines of this execution. The callbacks run before
+        # their results are ready, so the routines they dispatch are already
+        # in the deque when it's checked again.
+        while results:
+            results.popleft().get()
         AutoEnc._save_out_analysis(img_pathnames, out_folder, bpps, metrics)
+        for shared in (bpps, metrics):
+            shared.close()
+            shared.unlink()
 
     @staticmethod
-    def _save_imgs_from_patches(orig_path, save_folder, patches,
-                                bpp_proxy, metrics_proxy, pos, color='RGB'):
-        """ Function that gets the predicted patches, and reconstruct the image.
+    def _calc_metrics_from_patches(orig_path, patches, metrics_proxy, codec,
+                                   pos, color='RGB'):
+        """ Function that compares the predicted patches with the original
+            image wrt all metrics
         """
         try:
             orig_ref = ImgProc.load_image(orig_path, ImgData.UBYTE, color)
 
-            for metric in Metrics:
-                metrics_proxy[metric[0]][pos] = ImgProc.calc_metric(
-                    orig_ref, patches, metric)
-            cont = 0
-            while not bpp_proxy[pos]:
-                time.sleep(1)
-                if cont > 100:
-                    AutoEnc._timeout_msg(AutoEnc._save_imgs_from_patches,
-                                         orig_path)
-                    return
-            new_path = AutoEnc.get_out_pathname(orig_path, save_folder, '.png')
-            ImgProc.save_img(patches, new_path, color)
+            results = ImgProc.calc_all_metrics(orig_ref, patches)
+            # dims: (metrics, levels), metrics in the order of their values
+            values = np.array([results[m] for m in
+                               sorted(Metrics, key=lambda m: m[0])])
+            metrics_proxy[codec, :, pos] = values[:, None]
         except Exception:
             print_exc()
 
@@ -300,28 +479,160 @@ class AutoEnc:
         save_name = save_folder / new_name
         return save_name
 
+    def _data_to_device(self, data):
+        """ Move a batch to the device of the model, using the same memory
+            format of the model. Batches of encoded JPEGs are decoded in it.
+        """
+        if isinstance(data, list):
+            data = [decode_jpeg(d, mode=ImageReadMode.RGB, device=self.device)
+                    for d in data]
+            data = torch.stack(data).float().div_(255.0)
+        data = data.to(self.device, non_blocking=True)
+        if self.device.type == 'cuda' and hasattr(torch, 'channels_last'):
+            data = data.contiguous(memory_format=torch.channels_last)
+        return data
+
+    def _outputs_to_host(self, output, latents):
+        """ Start the copy of the outputs of a batch to the host, with only
+            one transfer per tensor. The images are converted to ubyte before,
+            so less data is transferred. In GPUs, the copy is done in its own
+            stream, into one of two alternate pinned buffers, so the next
+            batch runs while it's transferred. It returns the CHW ubyte images
+            and the latents, with the event to wait for them (or None).
+        """
+        st = self.st
+        imgs = output.detach().mul(255).clamp_(0, 255).to(torch.uint8)
+        out = [imgs, latents.detach()]
+        if self.device.type != 'cuda':
+            return out, None
+
+        if st.copy_stream is None:
+            st.copy_stream = torch.cuda.Stream()
+        st.staging_idx = 1 - st.staging_idx
+        bufs = st.staging[st.staging_idx]
+        if bufs is None or bufs[0].shape != imgs.shape:
+            bufs = [torch.empty_like(t, device='cpu', pin_memory=True)
+                    for t in out]
+            st.staging[st.staging_idx] = bufs
+        st.copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(st.copy_stream):
+            for buf, t in zip(bufs, out):
+                buf.copy_(t, non_blocking=True)
+                # Keep the memory of t until the copy ends
+                t.record_stream(st.copy_stream)
+            event = st.copy_stream.record_event()
+        return bufs, event
+
+    def _put_outputs(self, host_copy):
+        """ Wait the copy of a batch to the host and put each of its samples
+            in the output queue
+        """
+        (imgs, latents), event = host_copy
+        if event is not None:
+            event.synchronize()
+            # The pinned buffers are reused two batches later
+            imgs, latents = imgs.clone(), latents.clone()
+        for j in range(len(imgs)):
+            self.st.out_queue.put([imgs[j], latents[j]])
+
+    def _amp_enabled(self):
+        """ Automatic mixed precision is used only in GPUs and if the
+            installed torch version supports it
+        """
+        return self.device.type == 'cuda' and hasattr(torch.cuda, 'amp')
+
+    def _autocast(self):
+        """ Context in which the forward of the model and the loss are
+            computed
+        """
+        if self._amp_enabled():
+            # float16 is the default type, and autocast only accepts the
+            # dtype argument in recent torch versions
+            return torch.cuda.amp.autocast()
+        return nullcontext()
+
     def _update_opt(self):
+        """ Apply the next learning rate and momentum of the schedule to the
+            optimizer. The model has only one group of parameters.
+        """
         lr, mom = self.st.opt_schedules[0].calc()
-        param_groups = self.st.autoenc_opt[0].defaults
-        param_groups['lr'] = lr
-        if 'mom' in param_groups:
-            param_groups['mom'] = mom
+        param_group = self.st.autoenc_opt[0].param_groups[0]
+        param_group['lr'] = lr
+        if mom is not None and 'momentum' in param_group:
+            param_group['momentum'] = mom
 
     def _train_loop(self, data):
         st = self.st
 
-        data = data.to(self.device)
+        data = self._data_to_device(data)
+        with self._autocast():
+            # ===================forward=====================
+            # Prediction of the model
+            output, _ = st.autoenc[0](data)
+            # ===================backward=====================
+            # Backward pass:compute gradient of the loss with respect to all
+            # the learnable parameters of the model.
+            # Compute loss
+            loss = st.loss(output, data)
+        return loss
+
+    def _grad_sync(self, sync):
+        """ Context of the forward and backward of a micro step. Under DDP,
+            the gradients are only all-reduced in the last micro step of the
+            accumulation.
+        """
+        if not sync and self.world_size > 1:
+            return self.st.autoenc[0].no_sync()
+        return nullcontext()
+
+    def _backward(self, loss):
+        """ Backward pass. When using mixed precision, the loss is scaled to
+            avoid underflow in the gradients
+        """
+        if self.st.scaler:
+            self.st.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def _optimizer_step(self):
+        """ Update of the weights with the accumulated gradients """
+        st = self.st
+        if st.scaler:
+            st.scaler.step(st.autoenc_opt[0])
+            st.scaler.update()
+        else:
+            st.autoenc_opt[0].step()
         # Zero the gradients
         st.autoenc_opt[0].zero_grad()
-        # ===================forward=====================
-        # Prediction of the model
-        output, _ = st.autoenc[0](data)
-        # ===================backward=====================
-        # Backward pass:compute gradient of the loss with respect to all
-        # the learnable parameters of the model.
-        # Compute loss
-        loss = st.loss(output, data)
-        return loss
+
+    def _bare_model(self):
+        """ Return the model without the wrappers of torch.compile and DDP """
+        model = self.st.autoenc[0]
+        model = getattr(model, '_orig_mod', model)
+        return getattr(model, 'module', model)
+
+    def save_ckpt(self, state_dict, epoch, loss):
+        """ Save a checkpoint without blocking the training. The weights
+            are copied to the host here, in pinned buffers in GPUs, and
+            written to the disk by a background thread. They're always
+            copied, since the training keeps updating them in place.
+        """
+        if self.device.type == 'cuda':
+            cpu_sd = {k: torch.empty_like(v, device='cpu', pin_memory=True)
+                      .copy_(v.detach(), non_blocking=True)
+                      for k, v in state_dict.items()}
+            torch.cuda.current_stream().synchronize()
+        else:
+            cpu_sd = {k: v.detach().clone() for k, v in state_dict.items()}
+        path = Path(self.ckpt_path_pattern.format(epoch, loss))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._ckpt_futures.append(
+            self._ckpt_executor.submit(torch.save, cpu_sd, str(path)))
+
+    def _wait_ckpts(self):
+        """ Wait the pending checkpoints, raising their errors """
+        list(map(lambda f: f.result(), self._ckpt_futures))
+        self._ckpt_futures = []
 
     def _train(self):
         """ Function that trains the model. """
@@ -330,26 +641,50 @@ class AutoEnc:
         gen = self.generators[str(st.exec_mode)][1]
 
         epochs = run['epochs']
+        accum = run.get('accumulation_steps', 1)
         # Execution of the model
         iter_str = '{:d}/' + str(len(gen)) + ': {}'
+        # In distributed runs, only the first process prints the progress
+        verbose = self.rank == 0
         mean_loss = 0.
         st.autoenc[0].train()
+        st.autoenc_opt[0].zero_grad()
         for x in range(epochs):
-            print('Epoch {}/{}'.format(x + 1, epochs))
-            print('-' * 50)
+            if isinstance(gen.sampler, DistributedSampler):
+                gen.sampler.set_epoch(x)
+            if verbose:
+                print('Epoch {}/{}'.format(x + 1, epochs))
+                print('-' * 50)
+            epoch_loss = 0.
             for batch_idx, (data, _) in enumerate(gen):
-                loss = self._train_loop(data)
+                last_micro = (batch_idx + 1) % accum == 0 or \
+                    batch_idx + 1 == len(gen)
+                # The last window of the epoch may have less micro steps
+                window = min(accum, len(gen) - batch_idx // accum * accum)
+                # The forward must also be inside no_sync, otherwise DDP
+                # prepares the synchronization of the backward anyway
+                with self._grad_sync(last_micro):
+                    loss = self._train_loop(data)
+                    self._backward(loss / window)
                 # Update optimizer's parameters
-                loss.backward()
-                st.autoenc_opt[0].step()
-                self._update_opt()
-                print(iter_str.format(batch_idx + 1, str(loss.item())))
-                AutoEnc._clear_last_lines()
-                mean_loss += loss.item()
-            mean_loss /= len(gen)
-            AutoEnc._clear_last_lines(n=2)
-        print("Avg loss: {}".format(mean_loss / epochs))
-        st.autoenc_opt[0].defaults['lr'] = conf['lr_politics']['lr']
+                if last_micro:
+                    self._optimizer_step()
+                    self._update_opt()
+                # Each item() waits the device, so it's called just once
+                loss_val = loss.item()
+                if verbose:
+                    print(iter_str.format(batch_idx + 1, str(loss_val)))
+                    AutoEnc._clear_last_lines()
+                epoch_loss += loss_val
+            epoch_loss /= len(gen)
+            mean_loss += epoch_loss
+            if verbose:
+                AutoEnc._clear_last_lines(n=2)
+                self.save_ckpt(self._bare_model().state_dict(), x + 1,
+                               epoch_loss)
+        if verbose:
+            print("Avg loss: {}".format(mean_loss / epochs))
+        st.autoenc_opt[0].param_groups[0]['lr'] = conf['lr_politics']['lr']
 
     def _test(self):
         """ Function that tests the model. """
@@ -357,34 +692,48 @@ class AutoEnc:
         st, conf, run = self.st, self.auto_cfg, self.run_cfg
         gen = self.generators[str(st.exec_mode)][1]
 
-        st.out_queue = Manager().Queue(run['queue_size'])
-        patch_proc = Process(target=AutoEnc._handle_output, args=(self,))
+        st.out_queue = Queue(run['queue_size'])
+        patch_proc = Thread(target=self._handle_output, name='_handle_output')
         patch_proc.start()
 
         # Execution of the model
         iter_str = '{:d}/' + str(len(gen)) + ': {}'
         mean_loss = 0.
         st.autoenc[0].eval()
-        for batch_idx, (data, _) in enumerate(gen):
-            data = data.to(self.device)
-            # Prediction of the model
-            output, latents = st.autoenc[0](data)
-            # Compute loss
-            loss = st.loss(output, data)
-            print(iter_str.format(batch_idx + 1, str(loss.item())))
-            AutoEnc._clear_last_lines()
-            for j in range(output.size()[0]):
-                put = [np.array(
-                    self.generators['img'](output.cpu().data[j]))] + \
-                      [latents.cpu().data[j].numpy()]
-                st.out_queue.put(put)
-            mean_loss += loss.item()
+        # No gradients are needed, and under DDP this also keeps the forward
+        # free of collective operations with the other processes
+        pending = None
+        with torch.no_grad():
+            for batch_idx, (data, _) in enumerate(gen):
+                data = self._data_to_device(data)
+                with self._autocast():
+                    # Prediction of the model
+                    output, latents = st.autoenc[0](data)
+                    # Compute loss
+                    loss = st.loss(output, data)
+                # Keep the outputs analysis in single precision
+                output, latents = output.float(), latents.float()
+                host_copy = self._outputs_to_host(output, latents)
+                # The previous batch was copied while this one was running
+                if pending:
+                    self._put_outputs(pending)
+                pending = host_copy
+                # Each item() waits the device, so it's called just once
+                loss_val = loss.item()
+                print(iter_str.format(batch_idx + 1, str(loss_val)))
+                AutoEnc._clear_last_lines()
+                mean_loss += loss_val
+        if pending:
+            self._put_outputs(pending)
         mean_loss /= len(gen)
         print("Avg loss: {}".format(mean_loss))
         patch_proc.join()
 
     def test_model(self):
         """ Evaluate the eager model for validation or testing """
+        # The outputs are analysed just once, by the first process
+        if self.rank != 0:
+            return
         if not self.st:
             self.st = self.State(exec_mode=ExecMode.TEST)
             self._create_model()
@@ -401,3 +750,4 @@ class AutoEnc:
         self.st.exec_mode = ExecMode.TRAIN
         self.st.out_type = OutputType.NONE
         self._train()
+        self._wait_ckpts()
@@ -9,6 +9,7 @@ from itertools import repeat
 from multiprocessing.pool import ThreadPool
 import pandas as pd
 import os
+from torch.utils.data import Dataset
 
 
 class Generator:
@@ -70,3 +71,24 @@ class Generator:
             lambda p: Path(self.gen_conf['path']) / p, paths))
         self._img_paths = np.array(self._img_paths, dtype=object)
 
+
+class ImgDataset(Dataset):
+    """ Torch dataset with the images indexed by a Generator. It reuses the
+    index of the database, so its folder isn't scanned again, and the
+    samples follow the order of the generator pathnames """
+
+    def __init__(self, generator, loader, transform=None):
+        self.samples = [(str(p), 0)
+                        for p in generator.get_db_files_pathnames()]
+        self.loader = loader
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        sample = self.loader(path)
+        if self.transform:
+            sample = self.transform(sample)
+        return sample, target
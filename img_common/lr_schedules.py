@@ -31,7 +31,8 @@ class CLR(object):
     def calc(self):
         self.itr += 1
         lr = self.calc_lr()
-        return np.float(lr), 1
+        # The momentum isn't cycled by this policy
+        return np.float(lr), None
 
     def calc_lr(self):
         cycle = np.floor(1 + self.itr/(2*self.step_size))
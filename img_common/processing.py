@@ -11,7 +11,7 @@ from pathlib import PosixPath
 from pathlib import Path
 import warnings
 
-from .enums import ImgData
+from .enums import ImgData, Metrics
 
 
 class ImgProc:
@@ -139,16 +139,22 @@ class ImgProc:
             print("calc_bpp_using_gzip: " + str(e), end='\n\n')
 
     @staticmethod
-    def calc_metric(true_ref, test_ref, metric):
-        """ Method responsible for calculating all available metrics to the
-            code
+    def _metric_refs_to_arrays(true_ref, test_ref):
+        """ Auxiliary function of the metrics that opens the references, if
+            they're paths, and converts them to arrays
         """
         if isinstance(true_ref, (Path, str)):
             true_ref = Image.open(true_ref)
         if isinstance(test_ref, (Path, str)):
             test_ref = Image.open(test_ref)
-        true_ref = np.array(true_ref)
-        test_ref = np.array(test_ref)
+        return np.array(true_ref), np.array(test_ref)
+
+    @staticmethod
+    def calc_metric(true_ref, test_ref, metric):
+        """ Method responsible for calculating all available metrics to the
+            code
+        """
+        true_ref, test_ref = ImgProc._metric_refs_to_arrays(true_ref, test_ref)
 
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
@@ -159,6 +165,25 @@ class ImgProc:
 
         return result
 
+    @staticmethod
+    def calc_all_metrics(true_ref, test_ref):
+        """ Method that calculates all the metrics at once, opening and
+            converting the references just once. It returns a dict with the
+            result of each metric.
+        """
+        true_ref, test_ref = ImgProc._metric_refs_to_arrays(true_ref, test_ref)
+
+        results = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+
+            for metric in Metrics:
+                result = metric[1](true_ref, test_ref)
+                results[metric] = np.iinfo(np.uint8).max \
+                    if result == float('inf') else result
+
+        return results
+
     @staticmethod
     def save_img(img_ref, path, mode='RGB'):
         """ Method that receives a numpy array and a path. It saves an image
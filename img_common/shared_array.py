@@ -0,0 +1,42 @@
+""" File containing a numpy array that can be shared among processes """
+
+import os
+import tempfile
+import numpy as np
+
+
+class SharedArray:
+    """ Numpy array mapped on a file, in /dev/shm when available so that it
+        stays in memory. When it's pickled, e.g. sent as argument to a pool,
+        only the name of the file is sent. This way, all processes read and
+        write the same buffer directly, without a manager in between.
+    """
+    _folder = '/dev/shm' if os.path.isdir('/dev/shm') \
+        else tempfile.gettempdir()
+
+    def __init__(self, name, shape, dtype=np.float64, create=True):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._path = os.path.join(SharedArray._folder, name)
+        self.array = np.memmap(self._path, self.dtype,
+                               'w+' if create else 'r+', shape=self.shape)
+
+    def __reduce__(self):
+        return SharedArray, (self.name, self.shape, self.dtype, False)
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __setitem__(self, key, value):
+        self.array[key] = value
+
+    def close(self):
+        """ Detach the current process from the shared buffer """
+        self.array = None
+
+    def unlink(self):
+        """ Remove the shared file. It must be called just once, by the
+            process that created it
+        """
+        os.remove(self._path)